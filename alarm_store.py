@@ -0,0 +1,221 @@
+# alarm_store.py
+# Rappresentazione compatta in memoria degli allarmi di tutti i Pi, condivisa da handler e thread di controllo.
+# Ogni allarme è un intero a 64 bit: (minuto locale << PI_INDEX_BITS) | indice del pi_id.
+
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # NumPy è opzionale: senza, il matching usa la ricerca binaria su array
+    np = None
+
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%H:%M"
+MINUTES_PER_DAY = 24 * 60
+PI_INDEX_BITS = 24               # Fino a ~16M pi_id; il minuto resta in 39 bit (anno 9999 incluso)
+PI_INDEX_MASK = (1 << PI_INDEX_BITS) - 1
+
+
+def _parse_exact(value: str, fmt: str):
+    """Ritorna il datetime solo se value è già nel formato canonico (stesso confronto per stringhe di prima)."""
+    try:
+        parsed = datetime.strptime(value, fmt)
+    except ValueError:
+        return None
+    return parsed if parsed.strftime(fmt) == value else None
+
+
+def _day_start_minute(date_str: str) -> int | None:
+    """Minuto di inizio giornata per 'YYYY-MM-DD', o None se non valida."""
+    parsed = _parse_exact(date_str, DATE_FORMAT)
+    return parsed.toordinal() * MINUTES_PER_DAY if parsed else None
+
+
+def _minute_of_day(time_str: str) -> int | None:
+    """Minuto del giorno per 'HH:MM', o None se non valida."""
+    parsed = _parse_exact(time_str, TIME_FORMAT)
+    return parsed.hour * 60 + parsed.minute if parsed else None
+
+
+def _cached(cache: dict, value, parse):
+    """Applica parse con memoizzazione; None per valori non stringa."""
+    if not isinstance(value, str):
+        return None
+    if value not in cache:
+        cache[value] = parse(value)
+    return cache[value]
+
+
+def to_epoch_minute(date_str: str, time_str: str) -> int | None:
+    """Converte data 'YYYY-MM-DD' e ora 'HH:MM' locali nei minuti trascorsi da 0001-01-01 00:00."""
+    day = _day_start_minute(date_str)
+    minute_of_day = _minute_of_day(time_str)
+    if day is None or minute_of_day is None:
+        return None
+    return day + minute_of_day
+
+
+class PackedAlarmStore:
+    """
+    Allarmi di tutti i Pi in un unico buffer array('q') ordinato, tenuto in vita per tutta
+    l'esecuzione del bot e aggiornato in place da /add, /delete e dagli allarmi scattati.
+    reload() lo riallinea periodicamente a Firebase senza perdere le modifiche concorrenti.
+    I pi_id sono internati e referenziati per indice, per cui il costo è ~8 byte per allarme.
+    """
+
+    __slots__ = ("pi_ids", "_pi_index", "_packed", "_lock", "_journal")
+
+    def __init__(self):
+        self.pi_ids = []
+        self._pi_index = {}
+        self._packed = array('q')
+        self._lock = threading.Lock()  # Usato dagli handler (event loop) e dal thread di controllo
+        self._journal = None           # Modifiche [(add, pi_id, minute)] registrate durante un reload()
+
+    @classmethod
+    def from_pi_alarms(cls, all_pi_alarms: dict) -> "PackedAlarmStore":
+        """Costruisce lo store da {pi_id: [{"date": ..., "time": ...}, ...]} (output di load_all_pi_alarms)."""
+        store = cls()
+        # Cache dei formati già visti: in pratica poche date e al massimo 1440 orari distinti
+        day_cache = {}
+        time_cache = {}
+
+        for pi_id, pi_alarms in all_pi_alarms.items():
+            if not isinstance(pi_alarms, list):
+                continue
+            pi_index = store._intern(pi_id)
+
+            for alarm in pi_alarms:
+                if not isinstance(alarm, dict):
+                    continue
+                day = _cached(day_cache, alarm.get("date"), _day_start_minute)
+                minute_of_day = _cached(time_cache, alarm.get("time"), _minute_of_day)
+                if day is None or minute_of_day is None:
+                    continue  # Allarme malformato: non potrebbe mai corrispondere
+                store._packed.append(((day + minute_of_day) << PI_INDEX_BITS) | pi_index)
+
+        if np is not None:
+            np.frombuffer(store._packed, dtype=np.int64).sort()  # Ordinamento in-place sul buffer dell'array
+        else:
+            store._packed = array('q', sorted(store._packed))
+        return store
+
+    def _intern(self, pi_id: str) -> int:
+        """Indice del pi_id, aggiungendolo se non ancora noto."""
+        pi_index = self._pi_index.get(pi_id)
+        if pi_index is None:
+            pi_index = len(self.pi_ids)
+            if pi_index > PI_INDEX_MASK:
+                raise OverflowError("Troppi pi_id per PackedAlarmStore.")
+            pi_id = sys.intern(str(pi_id))
+            self.pi_ids.append(pi_id)
+            self._pi_index[pi_id] = pi_index
+        return pi_index
+
+    def _find(self, key: int) -> int:
+        """Posizione di key nel buffer ordinato, o -1 se assente."""
+        i = bisect_left(self._packed, key)
+        return i if i < len(self._packed) and self._packed[i] == key else -1
+
+    def __len__(self) -> int:
+        return len(self._packed)
+
+    def contains(self, pi_id: str, date_str: str, time_str: str) -> bool:
+        """True se il Pi ha già un allarme alla data/ora indicate."""
+        minute = to_epoch_minute(date_str, time_str)
+        with self._lock:
+            pi_index = self._pi_index.get(pi_id)
+            if minute is None or pi_index is None:
+                return False
+            return self._find((minute << PI_INDEX_BITS) | pi_index) >= 0
+
+    def _insert_locked(self, pi_id: str, minute: int) -> bool:
+        """Inserisce (pi_id, minute) mantenendo l'ordinamento; False se già presente."""
+        key = (minute << PI_INDEX_BITS) | self._intern(pi_id)
+        i = bisect_left(self._packed, key)
+        if i < len(self._packed) and self._packed[i] == key:
+            return False
+        self._packed.insert(i, key)
+        return True
+
+    def _remove_locked(self, pi_id: str, minute: int) -> bool:
+        """Rimuove (pi_id, minute); False se non presente."""
+        pi_index = self._pi_index.get(pi_id)
+        i = self._find((minute << PI_INDEX_BITS) | pi_index) if pi_index is not None else -1
+        if i < 0:
+            return False
+        del self._packed[i]
+        return True
+
+    def add(self, pi_id: str, date_str: str, time_str: str) -> bool:
+        """Inserisce un allarme mantenendo l'ordinamento; False se malformato o già presente."""
+        minute = to_epoch_minute(date_str, time_str)
+        if minute is None:
+            return False
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((True, pi_id, minute))
+            return self._insert_locked(pi_id, minute)
+
+    def remove(self, pi_id: str, date_str: str, time_str: str) -> bool:
+        """Rimuove un allarme; False se non presente."""
+        minute = to_epoch_minute(date_str, time_str)
+        if minute is None:
+            return False
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((False, pi_id, minute))
+            return self._remove_locked(pi_id, minute)
+
+    def reload(self, load_all) -> bool:
+        """
+        Ricostruisce lo store da load_all() (es. load_all_pi_alarms; None = errore, store invariato).
+        Le modifiche fatte durante la lettura vengono registrate e riapplicate al nuovo buffer,
+        così un /add concorrente non va perso se la lettura non lo include ancora.
+        """
+        with self._lock:
+            self._journal = []
+        try:
+            all_pi_alarms = load_all()
+            if all_pi_alarms is None:
+                return False
+            fresh = PackedAlarmStore.from_pi_alarms(all_pi_alarms)
+            with self._lock:
+                for is_add, pi_id, minute in self._journal:
+                    if is_add:
+                        fresh._insert_locked(pi_id, minute)
+                    else:
+                        fresh._remove_locked(pi_id, minute)
+                self.pi_ids, self._pi_index, self._packed = fresh.pi_ids, fresh._pi_index, fresh._packed
+            return True
+        finally:
+            with self._lock:
+                self._journal = None
+
+    def _due_range(self, minute: int) -> tuple:
+        """Indici [start, end) nel buffer degli allarmi del minuto indicato."""
+        low, high = minute << PI_INDEX_BITS, (minute + 1) << PI_INDEX_BITS
+        if np is not None:
+            start, end = np.frombuffer(self._packed, dtype=np.int64).searchsorted([low, high])
+            return int(start), int(end)
+        return bisect_left(self._packed, low), bisect_left(self._packed, high)
+
+    def due_pi_ids(self, minute: int) -> list:
+        """pi_id con un allarme al minuto indicato."""
+        with self._lock:
+            start, end = self._due_range(minute)
+            return [self.pi_ids[self._packed[i] & PI_INDEX_MASK] for i in range(start, end)]
+
+    def pop_due(self, minute: int) -> list:
+        """Come due_pi_ids, ma rimuove anche gli allarmi restituiti dal buffer."""
+        with self._lock:
+            start, end = self._due_range(minute)
+            due = [self.pi_ids[self._packed[i] & PI_INDEX_MASK] for i in range(start, end)]
+            del self._packed[start:end]
+            if self._journal is not None:
+                self._journal.extend((False, pi_id, minute) for pi_id in due)
+            return due
@@ -0,0 +1,108 @@
+# bench_alarm_store.py
+# Confronta, per ogni tick del checker, memoria e tempo di tre approcci:
+#  - dict-of-lists letto da Firebase e scansione lineare (checker originale);
+#  - PackedAlarmStore ricostruito ad ogni tick (build + match);
+#  - PackedAlarmStore costruito una volta e aggiornato in place (checker attuale).
+# I tempi non includono la lettura di /alarms da Firebase, che i primi due approcci pagano ad ogni tick.
+# Uso: python bench_alarm_store.py [--alarms 1000000] [--pis 50000]
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from alarm_store import PackedAlarmStore, to_epoch_minute
+
+
+def generate_pi_alarms(n_alarms: int, n_pis: int, seed: int = 42) -> dict:
+    """Genera {pi_id: [{"date": ..., "time": ...}]} con stringhe distinte come dopo il parsing JSON."""
+    rng = random.Random(seed)
+    start = date(2025, 1, 1)
+    alarms_by_key = {f"pi{i:05d}": {} for i in range(n_pis)}
+    pi_ids = list(alarms_by_key)
+    generated = 0
+    while generated < n_alarms:
+        date_str = (start + timedelta(days=rng.randrange(30))).strftime("%Y-%m-%d")
+        time_str = f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"
+        pi_alarms = alarms_by_key[rng.choice(pi_ids)]
+        if f"{date_str} {time_str}" not in pi_alarms:  # Come in /alarms/{pi_id}: una sola sveglia per data/ora
+            pi_alarms[f"{date_str} {time_str}"] = {"date": date_str, "time": time_str}
+            generated += 1
+    return {pi_id: list(pi_alarms.values()) for pi_id, pi_alarms in alarms_by_key.items()}
+
+
+def measure_memory(build):
+    """Esegue build() e ritorna (risultato, byte ancora allocati, picco di byte allocati)."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, peak
+
+
+def scan_dict_of_lists(all_pi_alarms: dict, date_str: str, time_str: str) -> list:
+    """Matching lineare identico a quello del checker originale."""
+    matches = []
+    for pi_id, pi_alarms_list in all_pi_alarms.items():
+        for alarm in pi_alarms_list:
+            if isinstance(alarm, dict) and alarm.get("date") == date_str and alarm.get("time") == time_str:
+                matches.append(pi_id)
+    return matches
+
+
+def best_of(func, repeat: int = 5) -> float:
+    """Tempo minimo in secondi su più esecuzioni."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PackedAlarmStore vs dict-of-lists")
+    parser.add_argument("--alarms", type=int, default=1_000_000)
+    parser.add_argument("--pis", type=int, default=50_000)
+    args = parser.parse_args()
+
+    all_pi_alarms, dict_bytes, _ = measure_memory(lambda: generate_pi_alarms(args.alarms, args.pis))
+    store, store_bytes, build_peak = measure_memory(lambda: PackedAlarmStore.from_pi_alarms(all_pi_alarms))
+
+    date_str, time_str = "2025-01-15", "07:30"
+    minute = to_epoch_minute(date_str, time_str)
+    assert sorted(scan_dict_of_lists(all_pi_alarms, date_str, time_str)) == sorted(store.due_pi_ids(minute))
+
+    scan_time = best_of(lambda: scan_dict_of_lists(all_pi_alarms, date_str, time_str))
+    rebuild_time = best_of(lambda: PackedAlarmStore.from_pi_alarms(all_pi_alarms).due_pi_ids(minute), repeat=3)
+    due_time = best_of(lambda: store.due_pi_ids(minute))
+
+    # Aggiornamenti in place come quelli di /add e /delete (inserimento/rimozione nel buffer ordinato)
+    n_updates = 1000
+    start = time.perf_counter()
+    for i in range(n_updates):
+        store.add(f"pi{i % args.pis:05d}", "2025-03-01", f"{(i // 60) % 24:02d}:{i % 60:02d}")
+    for i in range(n_updates):
+        store.remove(f"pi{i % args.pis:05d}", "2025-03-01", f"{(i // 60) % 24:02d}:{i % 60:02d}")
+    update_time = (time.perf_counter() - start) / (2 * n_updates)
+
+    mb = 1024 * 1024
+    print(f"Allarmi: {args.alarms:,}  Pi: {args.pis:,}")
+    print(f"{'':34}{'byte/allarme':>14}{'picco (MB)':>12}{'per tick (ms)':>15}")
+    # Checker originale: ad ogni tick tiene in memoria tutti i dizionari e li scansiona
+    print(f"{'dict-of-lists (scan)':34}{dict_bytes / args.alarms:>14.1f}{dict_bytes / mb:>12.1f}{scan_time * 1000:>15.3f}")
+    # Ricostruzione ad ogni tick: dizionari + buffer in costruzione
+    print(f"{'store ricostruito (build+match)':34}{(dict_bytes + store_bytes) / args.alarms:>14.1f}"
+          f"{(dict_bytes + build_peak) / mb:>12.1f}{rebuild_time * 1000:>15.3f}")
+    # Store persistente: i dizionari esistono solo all'avvio, a regime resta il buffer
+    print(f"{'store persistente (match)':34}{store_bytes / args.alarms:>14.1f}"
+          f"{store_bytes / mb:>12.1f}{due_time * 1000:>15.3f}")
+    print(f"Avvio store persistente: picco {(dict_bytes + build_peak) / mb:.1f} MB (una sola volta)")
+    print(f"Aggiornamento in place (add/remove): {update_time * 1e6:.1f} µs per operazione")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # clock.py
 # Legge trigger da Firebase, controlla LED/LCD, bottone disabilitazione,
 # bottone mostra ID, gestisce il vibrator motor, e resetta il flag di disabilitazione all'inizio di ogni nuovo minuto.
+# I trigger sono lease con scadenza: la sveglia si spegne da sola quando il lease scade.
 
 import RPi.GPIO as GPIO
 from Adafruit_CharLCD import Adafruit_CharLCD
@@ -40,6 +41,7 @@ DISABLED_MESSAGE_DURATION = 8     # Secondi per cui mostrare "Sveglia disab."
 ID_DISPLAY_DURATION = 12          # Secondi per cui mostrare l'ID Pi
 VIBRATOR_MESSAGE_DURATION = 2     # Durata in secondi del messaggio sullo schermo per il vibrator motor
 PI_ID_FILENAME = "pi_id.txt"      # Nome del file per salvare l'ID
+LEASE_CLOCK_SKEW_TOLERANCE = 10 * 60  # Secondi di sfasamento orologio tollerati prima di scartare un lease come vecchio
 # --- Fine Configurazione Utente ---
 
 
@@ -48,6 +50,8 @@ alarm_manually_disabled = False      # Flag per disabilitazione manuale
 time_button_pressed = None           # Timestamp della pressione del bottone disabilitazione
 last_lcd_message = ""
 last_trigger_state = False           # Stato precedente del trigger ricevuto da Firebase
+lease_deadline = None                # time.monotonic() a cui scade il lease attivo
+last_lease_started_at = None         # started_at dell'ultimo lease gestito, anche dopo la scadenza (anti-replay)
 display_mode = 'clock'               # 'clock', 'showing_id' o 'vibrator_message'
 id_display_start_time = None         # Timestamp per timeout display ID
 vibrator_motor_enabled = True        # Vibrator motor abilitato di default
@@ -86,6 +90,12 @@ firebase_admin.initialize_app(cred, {
     "databaseURL": FIREBASE_DB_URL
 })
 
+# Registra il Pi in /devices: il bot accetta /pair solo per dispositivi registrati
+try:
+    db.reference(f"/devices/{MY_PI_ID}").update({"last_boot": int(time.time())})
+except Exception as e:
+    print(f"Errore nel registrare il dispositivo su Firebase: {e}")
+
 # --- Setup Hardware ---
 lcd = None
 disable_button = None
@@ -132,45 +142,81 @@ def turn_off_leds():
 def on_trigger_change(event):
     """
     Eseguito non appena cambia il valore in /triggers/MY_PI_ID.
-    event.data == True  → accendi sveglia
-    event.data == False → spegni sveglia
+    event.data == {"duration": ..., "started_at": ..., ...} → accendi sveglia per `duration` secondi
+    event.data == True                                     → accendi sveglia (formato precedente, senza scadenza)
+    event.data == False o None                             → spegni sveglia
+    La scadenza è calcolata con l'orologio monotono locale: il Pi Zero non ha RTC e il suo
+    orologio di sistema può essere sfasato rispetto al server. expires_at serve solo a scartare
+    lease vecchi (oltre LEASE_CLOCK_SKEW_TOLERANCE) e alla pulizia lato server.
     """
-    global alarm_manually_disabled, last_trigger_state
+    global alarm_manually_disabled, last_trigger_state, lease_deadline, last_lease_started_at
+
+    valore = event.data  # Può essere un lease (dict), True, False o None
+    if isinstance(valore, dict):
+        duration = valore.get("duration")
+        started_at = valore.get("started_at")
+        expires_at = valore.get("expires_at")
+        if isinstance(duration, (int, float)) and duration > 0:
+            if started_at is not None and started_at == last_lease_started_at:
+                return  # Lease già gestito (riconnessione, delete fallita, ...): non risuonare
+            last_lease_started_at = started_at
+            if isinstance(expires_at, (int, float)) and expires_at < time.time() - LEASE_CLOCK_SKEW_TOLERANCE:
+                print(f"DEBUG: Lease scaduto da tempo ignorato (started_at={started_at}).")
+                return  # Lease rimasto in Firebase (es. dopo un riavvio di clock.py)
+            # Nuovo lease → accendi sveglia (o riarma la scadenza se già attiva)
+            lease_deadline = time.monotonic() + duration
+            if not last_trigger_state:
+                alarm_manually_disabled = False
+                light_leds()
+                last_trigger_state = True
+            return
+        # Lease malformato → trattalo come assenza di trigger
+        valore = None
 
-    valore = event.data  # Può essere True, False o None
     if valore is True and not last_trigger_state:
         # Nuovo trigger a True → accendi sveglia
         alarm_manually_disabled = False
+        lease_deadline = None
         light_leds()
         last_trigger_state = True
 
-    elif valore is False and last_trigger_state:
-        # Trigger tornato a False → spegni sveglia
+    elif valore is not True and last_trigger_state:
+        # Trigger rimosso o tornato a False → spegni sveglia
         alarm_manually_disabled = False
+        lease_deadline = None
         turn_off_leds()
         last_trigger_state = False
 
-    # Se valore è None o uguale allo stato precedente, non fare nulla
+
+def expire_lease_if_needed():
+    """Spegne la sveglia quando il lease attivo è scaduto, senza attendere il server."""
+    global alarm_manually_disabled, last_trigger_state, lease_deadline
+
+    if last_trigger_state and lease_deadline is not None and time.monotonic() >= lease_deadline:
+        alarm_manually_disabled = False
+        lease_deadline = None
+        turn_off_leds()
+        last_trigger_state = False
 
 
 # --- Callback per il bottone di disabilitazione ---
 def disable_button_pressed_callback():
     """
     Callback per il bottone DISABLE_BUTTON_PIN.
-    Se c'è una sveglia in corso, la disabilita e azzera anche il trigger in Firebase.
+    Se c'è una sveglia in corso, la disabilita e rimuove anche il lease in Firebase.
     """
     global alarm_manually_disabled, time_button_pressed
 
     if last_trigger_state and not alarm_manually_disabled:
         alarm_manually_disabled = True
         time_button_pressed = time.monotonic()
-        turn_off_leds()
+        turn_off_leds()  # La scadenza locale resta armata: azzera lo stato anche se la delete fallisce
 
         try:
-            db.reference(f'/triggers/{MY_PI_ID}').set(False)
-            print("DEBUG: Trigger resettato a False su Firebase (button disable).")
+            db.reference(f'/triggers/{MY_PI_ID}').delete()
+            print("DEBUG: Lease del trigger rimosso da Firebase (button disable).")
         except Exception as e:
-            print(f"Errore nel resettare il trigger su Firebase: {e}")
+            print(f"Errore nel rimuovere il trigger su Firebase: {e}")
 
 
 # --- Callback per il bottone di visualizzazione ID ---
@@ -260,6 +306,9 @@ while True:
         current_minute = now.minute
         alarm_manually_disabled = False
 
+    # Spegnimento automatico alla scadenza del lease
+    expire_lease_if_needed()
+
     # Gestione timeout dei messaggi temporanei (ID e vibrator)
     if display_mode == 'showing_id' and id_display_start_time is not None:
         if time.monotonic() - id_display_start_time > ID_DISPLAY_DURATION:
@@ -0,0 +1,82 @@
+# quota_guard.py
+# Token bucket in memoria (per utente Telegram o per pi_id) che limitano le scritture su Firebase.
+# I bucket inattivi vengono rimossi periodicamente per non crescere senza limite.
+
+from collections import Counter
+import threading
+import time
+
+
+class TokenBucket:
+    """Bucket con `capacity` gettoni, ricaricato di `refill_rate` gettoni al secondo."""
+
+    __slots__ = ("capacity", "refill_rate", "tokens", "updated_at")
+
+    def __init__(self, capacity: float, refill_rate: float, now: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, now: float):
+        """Aggiunge i gettoni maturati dall'ultimo aggiornamento."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+
+class QuotaGuard:
+    """
+    Insieme di token bucket indicizzati per chiave (user_id o pi_id).
+    Tiene i contatori allowed/throttled/evicted esportati da snapshot().
+    """
+
+    def __init__(self, name: str, capacity: float, per_minute: float, idle_ttl: float, clock=time.monotonic):
+        self.name = name
+        self.capacity = capacity
+        self.refill_rate = per_minute / 60.0
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_eviction = clock()
+        self.stats = Counter()
+
+    def allow(self, key: str) -> bool:
+        """Consuma un gettone per key; False se la quota è esaurita."""
+        return self.allow_all([key])
+
+    def allow_all(self, keys: list) -> bool:
+        """Consuma un gettone per ogni chiave solo se tutte ne hanno almeno uno (tutto o niente)."""
+        with self._lock:
+            now = self._clock()
+            self._evict_idle_locked(now)
+            buckets = []
+            for key in set(keys):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(self.capacity, self.refill_rate, now)
+                bucket.refill(now)
+                buckets.append(bucket)
+
+            if any(bucket.tokens < 1 for bucket in buckets):
+                self.stats["throttled"] += 1
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.stats["allowed"] += 1
+            return True
+
+    def _evict_idle_locked(self, now: float):
+        """Rimuove i bucket inattivi da più di idle_ttl (al più una scansione ogni idle_ttl)."""
+        if now - self._last_eviction < self.idle_ttl:
+            return
+        idle = [key for key, bucket in self._buckets.items() if now - bucket.updated_at >= self.idle_ttl]
+        for key in idle:
+            del self._buckets[key]
+        self.stats["evicted"] += len(idle)
+        self._last_eviction = now
+
+    def snapshot(self) -> dict:
+        """Contatori correnti e numero di bucket attivi."""
+        with self._lock:
+            return {"buckets": len(self._buckets), **self.stats}
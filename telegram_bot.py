@@ -4,15 +4,21 @@
 
 import json
 import logging
+import re
 from datetime import datetime, timedelta
 import pytz
 import time
 import threading
 import signal # Per gestire SIGTERM/SIGINT nel thread
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update
 from telegram.ext import Application, CommandHandler, CallbackContext
+from telegram.helpers import escape_markdown
 import firebase_admin
 from firebase_admin import credentials, db
+from alarm_store import PackedAlarmStore, to_epoch_minute
+from quota_guard import QuotaGuard
 
 
 # --- Configurazione Utente ---
@@ -20,7 +26,19 @@ BOT_TOKEN = "7824989957:AAETWh9iqhzKDChpgDZ1GsMGijHUusOxziI"
 PATH_TO_FIREBASE_KEY = "firebaseKey.json" 
 FIREBASE_DB_URL = "https://svegliasordi-default-rtdb.europe-west1.firebasedatabase.app" 
 PI_ID = "pi45791" # Identificativo del Raspberry Pi da triggerare
+MAX_PARALLEL_READS = 8              # Letture Firebase concorrenti per i comandi su più dispositivi
+ALARM_LOAD_RETRY_INTERVAL = 5       # Secondi tra due tentativi di caricare /alarms all'avvio
+ALARM_STORE_RESYNC_INTERVAL = 60 * 60 # Secondi tra due riallineamenti completi dello store con /alarms
 TIMEZONE = "Europe/Rome"
+TRIGGER_LEASE_SECONDS = 60          # Durata di una sveglia attiva (lease), il Pi si spegne da solo alla scadenza
+LEASE_SWEEP_INTERVAL = 15 * 60      # Secondi tra due pulizie dei lease scaduti in /triggers
+USER_QUOTA_BURST = 10               # Comandi di scrittura consecutivi consentiti per utente Telegram
+USER_QUOTA_PER_MINUTE = 5           # Ricarica della quota utente (comandi/minuto)
+DEVICE_QUOTA_BURST = 20             # Scritture consecutive consentite per pi_id
+DEVICE_QUOTA_PER_MINUTE = 10        # Ricarica della quota dispositivo (scritture/minuto)
+QUOTA_IDLE_TTL = 30 * 60            # Secondi di inattività dopo cui un bucket viene rimosso (>= tempo di ricarica completa)
+METRICS_EXPORT_INTERVAL = 5 * 60    # Secondi tra due esportazioni delle metriche di quota su /metrics/quota
+GROUP_NAME_PATTERN = re.compile(r"[A-Za-z0-9-]{1,32}") # Nomi gruppo ammessi (sicuri per Firebase e Markdown)
 # --- Fine Configurazione Utente ---
 
 # Setup Logging
@@ -38,114 +56,322 @@ try:
 except Exception as e:
      logger.error(f"Errore inizializzazione Firebase: {e}", exc_info=True); exit()
 
+# Quote in memoria davanti agli handler che scrivono su Firebase
+user_quota = QuotaGuard("user", USER_QUOTA_BURST, USER_QUOTA_PER_MINUTE, QUOTA_IDLE_TTL)
+device_quota = QuotaGuard("device", DEVICE_QUOTA_BURST, DEVICE_QUOTA_PER_MINUTE, QUOTA_IDLE_TTL)
+pairing_rejections = Counter() # Motivi di rifiuto di /pair ("invalid_format", "unknown_device", "lookup_error")
+alarm_store = PackedAlarmStore() # Tutti gli allarmi in memoria: caricato in main(), aggiornato in place e riallineato ogni ora
+
 # --- Funzioni Database Firebase ---
 
-def get_pi_id_for_user(user_id: str) -> str | None:
-    """Recupera il pi_id associato a un utente da /pairings/{user_id}."""
+def get_pi_ids_for_user(user_id: str) -> list:
+    """
+    Recupera i pi_id associati a un utente da /pairings/{user_id}.
+    Supporta sia il formato a insieme ({pi_id: True}) sia il vecchio formato a singola stringa.
+    """
     try:
         ref = db.reference(f'/pairings/{user_id}')
-        pi_id = ref.get()
-        return str(pi_id) if pi_id else None
+        pairing = ref.get()
+        if isinstance(pairing, dict):
+            return sorted(str(k) for k, v in pairing.items() if v)
+        return [str(pairing)] if pairing else []
     except Exception as e:
         logger.error(f"Errore leggendo pairing per {user_id}: {e}")
-        return None
+        return []
 
 def save_pairing(user_id: str, pi_id: str):
-    """Salva l'associazione utente-Pi."""
+    """Aggiunge un Pi all'insieme dei dispositivi associati all'utente."""
     try:
         ref = db.reference(f'/pairings/{user_id}')
-        ref.set(pi_id)
+        pairing = ref.get(shallow=True)
+        if pairing and not isinstance(pairing, dict):
+            # Vecchio formato a singola stringa: va riscritto come insieme
+            ref.set({str(pairing): True, pi_id: True})
+        else:
+            ref.child(pi_id).set(True)
     except Exception as e:
         logger.error(f"Errore salvando pairing per {user_id} -> {pi_id}: {e}")
 
-def delete_pairing(user_id: str):
-     """Rimuove l'associazione utente-Pi."""
+def delete_pairing(user_id: str, pi_id: str | None = None):
+     """Rimuove l'associazione utente-Pi (un solo Pi, oppure tutti se pi_id è None)."""
      try:
          ref = db.reference(f'/pairings/{user_id}')
-         ref.delete()
+         if pi_id is None:
+             ref.delete()
+             db.reference(f'/groups/{user_id}').delete()
+             return
+         pairing = ref.get(shallow=True)
+         if pairing and not isinstance(pairing, dict):
+             # Vecchio formato a singola stringa
+             if str(pairing) == pi_id:
+                 ref.delete()
+         else:
+             ref.child(pi_id).delete()
      except Exception as e:
          logger.error(f"Errore cancellando pairing per {user_id}: {e}")
 
+def is_valid_pi_id(pi_id: str) -> bool:
+    """Controlla che pi_id abbia il formato generato da clock.py ('pi' + 5 cifre)."""
+    return pi_id.startswith("pi") and len(pi_id) == 7 and pi_id[2:].isdigit()
+
+def device_exists(pi_id: str) -> bool | None:
+    """
+    Verifica, con letture shallow, che il Pi sia registrato in /devices o abbia allarmi o trigger.
+    Ritorna None se Firebase non risponde, per non confondere un errore con un dispositivo inesistente.
+    """
+    try:
+        for path in (f'/devices/{pi_id}', f'/alarms/{pi_id}', f'/triggers/{pi_id}'):
+            if db.reference(path).get(shallow=True) is not None:
+                return True
+        return False
+    except Exception as e:
+        logger.error(f"Errore verificando l'esistenza del dispositivo {pi_id}: {e}")
+        return None
+
+def load_groups_for_user(user_id: str) -> dict:
+    """Carica i gruppi dell'utente da /groups/{user_id} come {nome: [pi_id, ...]}."""
+    try:
+        groups = db.reference(f'/groups/{user_id}').get()
+        if not isinstance(groups, dict):
+            return {}
+        return {str(name): sorted(str(p) for p in members) for name, members in groups.items() if isinstance(members, dict)}
+    except Exception as e:
+        logger.error(f"Errore leggendo gruppi per {user_id}: {e}")
+        return {}
+
+def save_group(user_id: str, group_name: str, pi_ids: list):
+    """Salva (o sostituisce) un gruppo di dispositivi dell'utente."""
+    try:
+        db.reference(f'/groups/{user_id}/{group_name}').set({p: True for p in pi_ids})
+    except Exception as e:
+        logger.error(f"Errore salvando gruppo {group_name} per {user_id}: {e}")
+
+def delete_group(user_id: str, group_name: str):
+    """Rimuove un gruppo di dispositivi dell'utente."""
+    try:
+        db.reference(f'/groups/{user_id}/{group_name}').delete()
+    except Exception as e:
+        logger.error(f"Errore cancellando gruppo {group_name} per {user_id}: {e}")
+
+def resolve_target_pi_ids(user_id: str, paired_pi_ids: list, target: str | None) -> list:
+    """
+    Traduce il bersaglio di un comando in una lista di pi_id:
+    None → tutti i dispositivi associati, un pi_id associato → solo quello,
+    il nome di un gruppo → i suoi membri ancora associati.
+    """
+    if target is None:
+        return list(paired_pi_ids)
+    if target in paired_pi_ids:
+        return [target]
+    members = load_groups_for_user(user_id).get(target, [])
+    return [p for p in members if p in paired_pi_ids]
+
+
+def alarm_key(alarm: dict) -> str:
+    """Chiave Firebase di un allarme in /alarms/{pi_id}: 'YYYY-MM-DD HH:MM' (unica per Pi)."""
+    return f"{alarm.get('date')} {alarm.get('time')}"
+
+def normalize_alarms_node(node) -> dict:
+    """
+    Converte il contenuto di /alarms/{pi_id} in {alarm_key: alarm}.
+    Accetta anche il vecchio formato a lista e nodi misti (lista + chiavi nuove).
+    """
+    values = node if isinstance(node, list) else node.values() if isinstance(node, dict) else []
+    return {alarm_key(a): a for a in values if isinstance(a, dict)}
 
 def load_alarms_for_pi(pi_id: str) -> list:
     """Carica gli allarmi per un Pi specifico da /alarms/{pi_id}."""
     if not pi_id: return []
     try:
         ref = db.reference(f'/alarms/{pi_id}')
-        alarms = ref.get()
-        return alarms if isinstance(alarms, list) else []
+        return list(normalize_alarms_node(ref.get()).values())
     except Exception as e:
         logger.error(f"Errore leggendo allarmi per {pi_id}: {e}")
         return []
 
-def save_alarms_for_pi(pi_id: str, alarms: list):
-    """Salva la lista allarmi per un Pi specifico su /alarms/{pi_id}."""
-    if not pi_id: return
+def load_alarms_for_pis(pi_ids: list) -> dict:
+    """Carica in parallelo gli allarmi di più Pi, restituendo {pi_id: [alarms...]}."""
+    if not pi_ids: return {}
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_READS, len(pi_ids))) as executor:
+        return dict(zip(pi_ids, executor.map(load_alarms_for_pi, pi_ids)))
+
+def add_alarm_for_pis(pi_ids: list, alarm: dict) -> bool:
+    """Aggiunge lo stesso allarme a più Pi con un solo update multi-path, senza letture preventive."""
+    if not pi_ids: return True
     try:
-        ref = db.reference(f'/alarms/{pi_id}')
-        ref.set(alarms)
+        db.reference('/alarms').update({f"{pi_id}/{alarm_key(alarm)}": alarm for pi_id in pi_ids})
+        return True
     except Exception as e:
-        logger.error(f"Errore salvando allarmi per {pi_id}: {e}")
+        logger.error(f"Errore aggiungendo allarme {alarm} per {pi_ids}: {e}")
+        return False
 
-def load_all_pi_alarms() -> dict:
-    """Carica TUTTI gli allarmi di TUTTI i Pi da /alarms."""
+def delete_alarms(alarms_by_pi: dict) -> bool:
+    """Rimuove gli allarmi {pi_id: [alarm, ...]} con un solo update multi-path, senza letture preventive."""
+    updates = {f"{pi_id}/{alarm_key(a)}": None for pi_id, alarms in alarms_by_pi.items() for a in alarms}
+    if not updates: return True
+    try:
+        db.reference('/alarms').update(updates)
+        return True
+    except Exception as e:
+        logger.error(f"Errore cancellando allarmi per {sorted(alarms_by_pi)}: {e}")
+        return False
+
+def load_all_pi_alarms() -> dict | None:
+    """
+    Carica TUTTI gli allarmi di TUTTI i Pi da /alarms come {pi_id: [alarms...]} (None in caso di errore).
+    I Pi ancora nel vecchio formato a lista vengono convertiti con un unico update.
+    """
     try:
         ref = db.reference('/alarms')
         all_alarms_dict = ref.get()
-        # Filtra eventuali valori non-dizionario o chiavi non-stringa (poco probabile ma sicuro)
-        return {str(k): v for k, v in all_alarms_dict.items() if isinstance(k, str) and isinstance(v, list)} if isinstance(all_alarms_dict, dict) else {}
+        if not isinstance(all_alarms_dict, dict):
+            return {}
+        all_pi_alarms = {}
+        legacy_nodes = {}
+        for pi_id, node in all_alarms_dict.items():
+            normalized = normalize_alarms_node(node)
+            all_pi_alarms[str(pi_id)] = list(normalized.values())
+            if not isinstance(node, dict) or normalized.keys() != node.keys():
+                legacy_nodes[str(pi_id)] = normalized or None
+        if legacy_nodes:
+            logger.info(f"Converto {len(legacy_nodes)} Pi dal vecchio formato allarmi a lista.")
+            ref.update(legacy_nodes)
+        return all_pi_alarms
     except Exception as e:
         logger.error(f"Errore leggendo tutti gli allarmi dei Pi: {e}")
-        return {}
+        return None
+
+def reload_alarm_store() -> bool:
+    """Riallinea lo store in memoria a /alarms (lettura completa), mantenendo le modifiche concorrenti."""
+    if not alarm_store.reload(load_all_pi_alarms):
+        return False
+    logger.info(f"Store allarmi ricaricato da Firebase: {len(alarm_store)} allarmi.")
+    return True
+
+# --- Metriche Quota ---
+
+def export_quota_metrics():
+    """Registra nel log e salva su /metrics/quota i contatori di quota e di pairing rifiutati."""
+    metrics = {
+        **{guard.name: guard.snapshot() for guard in (user_quota, device_quota)},
+        "pairing_rejected": dict(pairing_rejections),
+        "updated_at": int(time.time()),
+    }
+    logger.info(f"Metriche quota: {metrics}")
+    try:
+        db.reference('/metrics/quota').set(metrics)
+    except Exception as e:
+        logger.error(f"Errore esportando le metriche di quota: {e}")
+
+# --- Funzioni Lease Trigger ---
+
+def make_trigger_lease(now_aware: datetime, duration: int = TRIGGER_LEASE_SECONDS) -> dict:
+    """Crea il record di attivazione (lease) da scrivere in /triggers/{pi_id}."""
+    started_at = int(now_aware.timestamp())
+    return {
+        "active": True,
+        "started_at": started_at,
+        "duration": duration,
+        "expires_at": started_at + duration,
+    }
+
+def sweep_expired_trigger_leases():
+    """
+    Rimuove da /triggers i lease scaduti (e i vecchi flag booleani) con un solo update.
+    Eseguita raramente: lo spegnimento non dipende da questa pulizia.
+    """
+    try:
+        current_triggers = db.reference('/triggers').get()
+        if not isinstance(current_triggers, dict):
+            return
+        now_ts = time.time()
+        stale = {
+            pi_id: None for pi_id, lease in current_triggers.items()
+            if not isinstance(lease, dict) or lease.get("expires_at", 0) <= now_ts
+        }
+        if stale:
+            db.reference('/triggers').update(stale)
+            logger.info(f"Rimossi {len(stale)} lease scaduti da /triggers.")
+    except Exception as e:
+        logger.error(f"Errore durante la pulizia dei lease scaduti: {e}")
 
-# --- Decorator per Controllo Pairing ---
+# --- Decorator per Controllo Quota e Pairing ---
 from functools import wraps
 
+async def consume_user_quota(update: Update, command: str) -> bool:
+    """Consuma un gettone della quota dell'utente; se esaurita risponde all'utente e ritorna False."""
+    user_id = str(update.effective_user.id)
+    if user_quota.allow(user_id):
+        return True
+    logger.warning(f"Quota {user_quota.name} esaurita per utente {user_id} su /{command}")
+    await update.message.reply_text("⏳ Troppi comandi in poco tempo, riprova tra qualche minuto.")
+    return False
+
+def require_quota(func):
+    """Decorator che limita la frequenza dei comandi di scrittura per utente Telegram."""
+    @wraps(func)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        if not await consume_user_quota(update, func.__name__):
+            return None # Blocca l'esecuzione del comando
+        return await func(update, context, *args, **kwargs)
+    return wrapper
+
 def require_pairing(func):
-    """Decorator per verificare se l'utente è associato a un Pi."""
+    """Decorator per verificare se l'utente è associato ad almeno un Pi."""
     @wraps(func)
     async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
         user_id = str(update.effective_user.id)
-        pi_id = get_pi_id_for_user(user_id)
-        if not pi_id:
+        pi_ids = get_pi_ids_for_user(user_id)
+        if not pi_ids:
             await update.message.reply_text(
                 "❗️ Non sei associato a nessun dispositivo.\n"
                 "Premi il bottone giallo sul tuo Raspberry Pi per vedere il suo ID, "
                 "poi usa il comando:\n`/pair ID_DEL_TUO_PI`"
             )
             return None # Blocca l'esecuzione del comando
-        # Passa il pi_id al contesto per usarlo nel comando
-        context.user_data['pi_id'] = pi_id
+        # Passa i pi_id al contesto per usarli nel comando
+        context.user_data['pi_ids'] = pi_ids
         return await func(update, context, *args, **kwargs)
     return wrapper
 
+def md_escape(text) -> str:
+    """Escape per parse_mode='Markdown' di testo scelto dall'utente (da usare fuori dagli span `codice`)."""
+    return escape_markdown(str(text), version=1)
+
+def sort_alarms(alarms: list) -> list:
+    """Ordina gli allarmi per data/ora (stesso ordine usato da /list e /delete)."""
+    return sorted(alarms, key=lambda x: f"{x.get('date', '0000-00-00')} {x.get('time', '00:00')}")
+
 # --- Funzioni Handler Comandi Bot  ---
 
 async def start(update: Update, context: CallbackContext):
     user_id = str(update.effective_user.id)
-    pi_id = get_pi_id_for_user(user_id)
+    pi_ids = get_pi_ids_for_user(user_id)
     welcome_message = (
         f"👋 Ciao, {update.effective_user.first_name}!\n"
     )
-    if pi_id:
-         welcome_message += f"Sei associato al dispositivo: `{pi_id}`\n\n"
+    if pi_ids:
+         welcome_message += f"Sei associato ai dispositivi: {', '.join(f'`{p}`' for p in pi_ids)}\n\n"
     else:
          welcome_message += "Non sei associato a nessun dispositivo.\nUsa `/pair ID_PI` per iniziare.\n\n"
 
     welcome_message += (
         "✅ Comandi:\n"
-        "🔹 `/pair ID_PI` - Associa questo bot al tuo rasperry pi usando il pi\\_id visibile cliccando sul bottone giallo del rasperry\n"
-        "🔹 `/unpair` - Dissocia questo bot dal tuo rasperry\n"
-        "🔹 `/add YYYY-MM-DD HH:MM` - Aggiungi sveglia (richiede pairing)\n"
-        "🔹 `/list` - Mostra sveglie (richiede pairing)\n"
-        "🔹 `/delete ID` - Elimina sveglia (richiede pairing)\n\n"
+        "🔹 `/pair ID_PI` - Associa questo bot a un rasperry pi usando il pi\\_id visibile cliccando sul bottone giallo del rasperry (puoi associarne più di uno)\n"
+        "🔹 `/unpair [ID_PI]` - Dissocia un rasperry (o tutti, senza ID)\n"
+        "🔹 `/group NOME ID_PI ...` - Crea un gruppo di dispositivi (`/group` per vederli)\n"
+        "🔹 `/ungroup NOME` - Elimina un gruppo\n"
+        "🔹 `/add YYYY-MM-DD HH:MM [ID_PI|GRUPPO]` - Aggiungi sveglia (di default su tutti i dispositivi)\n"
+        "🔹 `/list [ID_PI|GRUPPO]` - Mostra sveglie (richiede pairing)\n"
+        "🔹 `/delete ID [ID_PI]` - Elimina sveglia (richiede pairing)\n\n"
         "💾 Sveglie su Firebase! 🔥"
     )
     await update.message.reply_text(welcome_message, parse_mode='Markdown')
 
 
+@require_quota
 async def pair_command(update: Update, context: CallbackContext):
-    """Associa l'utente Telegram a un Pi ID."""
+    """Associa l'utente Telegram a un Pi ID (in aggiunta a quelli già associati)."""
     user_id = str(update.effective_user.id)
     if not context.args or len(context.args) != 1:
         await update.message.reply_text("❌ Formato non valido. Usa: `/pair ID_DEL_TUO_PI`\n(Trovi l'ID premendo il bottone giallo sul Pi).")
@@ -154,35 +380,128 @@ async def pair_command(update: Update, context: CallbackContext):
     if not pi_id_to_pair:
          await update.message.reply_text("❌ ID non valido.")
          return
+    if not is_valid_pi_id(pi_id_to_pair):
+         pairing_rejections["invalid_format"] += 1
+         await update.message.reply_text("❌ ID non valido. Il formato è `piXXXXX` (5 cifre).", parse_mode='Markdown')
+         return
+    if pi_id_to_pair in get_pi_ids_for_user(user_id):
+         await update.message.reply_text(f"ℹ️ Sei già associato al dispositivo `{pi_id_to_pair}`.", parse_mode='Markdown')
+         return
+    if not device_quota.allow(pi_id_to_pair):
+         await update.message.reply_text("⏳ Troppe richieste per questo dispositivo, riprova tra qualche minuto.")
+         return
+    exists = device_exists(pi_id_to_pair)
+    if exists is None:
+         pairing_rejections["lookup_error"] += 1
+         await update.message.reply_text("⚠️ Impossibile verificare il dispositivo in questo momento, riprova tra poco.")
+         return
+    if not exists:
+         pairing_rejections["unknown_device"] += 1
+         logger.warning(f"Utente {user_id} ha tentato il pairing con Pi inesistente {pi_id_to_pair}")
+         await update.message.reply_text(f"❌ Dispositivo `{pi_id_to_pair}` non trovato. Verifica che il Pi sia acceso e connesso.", parse_mode='Markdown')
+         return
 
     save_pairing(user_id, pi_id_to_pair)
     logger.info(f"Utente {user_id} associato a Pi {pi_id_to_pair}")
     await update.message.reply_text(f"✅ Associato con successo al dispositivo `{pi_id_to_pair}`!", parse_mode='Markdown')
 
+@require_quota
 async def unpair_command(update: Update, context: CallbackContext):
-     """Dissocia l'utente Telegram dal Pi."""
+     """Dissocia l'utente Telegram da un Pi, o da tutti se non viene indicato un ID."""
      user_id = str(update.effective_user.id)
-     pi_id = get_pi_id_for_user(user_id)
-     if not pi_id:
+     pi_ids = get_pi_ids_for_user(user_id)
+     if not pi_ids:
          await update.message.reply_text("ℹ️ Non sei attualmente associato a nessun dispositivo.")
          return
 
+     if context.args:
+         pi_id = context.args[0].strip()
+         if pi_id not in pi_ids:
+             await update.message.reply_text(f"❌ Non sei associato al dispositivo {md_escape(pi_id)}.", parse_mode='Markdown')
+             return
+         delete_pairing(user_id, pi_id)
+         logger.info(f"Utente {user_id} dissociato dal Pi {pi_id}")
+         await update.message.reply_text(f"✅ Associazione con il dispositivo `{pi_id}` rimossa.", parse_mode='Markdown')
+         return
+
      delete_pairing(user_id)
-     logger.info(f"Utente {user_id} dissociato dal Pi {pi_id}")
-     await update.message.reply_text(f"✅ Associazione con il dispositivo `{pi_id}` rimossa.", parse_mode='Markdown')
+     logger.info(f"Utente {user_id} dissociato dai Pi {pi_ids}")
+     await update.message.reply_text(f"✅ Associazione con i dispositivi {', '.join(f'`{p}`' for p in pi_ids)} rimossa.", parse_mode='Markdown')
+
+
+@require_pairing
+async def group_command(update: Update, context: CallbackContext):
+    """Crea/sostituisce un gruppo di dispositivi, oppure elenca i gruppi se chiamato senza argomenti."""
+    user_id = str(update.effective_user.id)
+    pi_ids = context.user_data.get('pi_ids', [])
+
+    if not context.args:
+        groups = load_groups_for_user(user_id)
+        if not groups:
+            await update.message.reply_text("ℹ️ Nessun gruppo. Usa `/group NOME ID_PI ...` per crearne uno.", parse_mode='Markdown')
+            return
+        message = "👥 Gruppi:\n"
+        for name, members in sorted(groups.items()):
+            message += f"🔹 {md_escape(name)}: {', '.join(md_escape(p) for p in members)}\n"
+        await update.message.reply_text(message, parse_mode='Markdown')
+        return
+
+    if len(context.args) < 2:
+        await update.message.reply_text("❌ Formato: `/group NOME ID_PI [ID_PI ...]`", parse_mode='Markdown')
+        return
+
+    group_name, members = context.args[0], sorted(set(context.args[1:]))
+    if group_name in pi_ids:
+        await update.message.reply_text("❌ Il nome del gruppo non può essere l'ID di un dispositivo.")
+        return
+    if not GROUP_NAME_PATTERN.fullmatch(group_name):
+        await update.message.reply_text("❌ Il nome del gruppo può contenere solo lettere, cifre e '-' (massimo 32 caratteri).")
+        return
+    not_paired = [p for p in members if p not in pi_ids]
+    if not_paired:
+        await update.message.reply_text(f"❌ Non sei associato a: {', '.join(md_escape(p) for p in not_paired)}", parse_mode='Markdown')
+        return
+
+    # Solo la creazione scrive su Firebase: l'elenco dei gruppi non consuma quota
+    if not await consume_user_quota(update, "group"):
+        return
+    save_group(user_id, group_name, members)
+    logger.info(f"Utente {user_id} ha creato il gruppo {group_name} con {members}")
+    await update.message.reply_text(f"✅ Gruppo `{group_name}`: {', '.join(f'`{p}`' for p in members)}", parse_mode='Markdown')
+
+@require_quota
+async def ungroup_command(update: Update, context: CallbackContext):
+    """Elimina un gruppo di dispositivi."""
+    user_id = str(update.effective_user.id)
+    if not context.args or len(context.args) != 1:
+        await update.message.reply_text("❌ Formato: `/ungroup NOME`", parse_mode='Markdown')
+        return
+    group_name = context.args[0]
+    if group_name not in load_groups_for_user(user_id):
+        await update.message.reply_text(f"❌ Gruppo {md_escape(group_name)} inesistente.", parse_mode='Markdown')
+        return
+
+    delete_group(user_id, group_name)
+    await update.message.reply_text(f"🗑️ Gruppo {md_escape(group_name)} eliminato.", parse_mode='Markdown')
 
 
 @require_pairing # Applica il controllo prima di eseguire
+@require_quota # Dopo il pairing: gli utenti non associati non consumano quota
 async def add_alarm(update: Update, context: CallbackContext):
-   
-    pi_id = context.user_data.get('pi_id')
-   
+    user_id = str(update.effective_user.id)
+    pi_ids = context.user_data.get('pi_ids', [])
+
+    if len(context.args) not in (2, 3):
+        await update.message.reply_text("❌ Formato: `/add YYYY-MM-DD HH:MM [ID_PI|GRUPPO]`")
+        return
 
-    if len(context.args) != 2:
-        await update.message.reply_text("❌ Formato: `/add YYYY-MM-DD HH:MM`")
+    date_str, time_str = context.args[:2]
+    target = context.args[2] if len(context.args) == 3 else None
+    target_pi_ids = resolve_target_pi_ids(user_id, pi_ids, target)
+    if not target_pi_ids:
+        await update.message.reply_text(f"❌ Dispositivo o gruppo {md_escape(target)} non trovato.", parse_mode='Markdown')
         return
 
-    date_str, time_str = context.args
     try:
         
         alarm_dt_naive = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
@@ -191,52 +510,77 @@ async def add_alarm(update: Update, context: CallbackContext):
         if alarm_dt_aware < now_aware - timedelta(minutes=1):
             await update.message.reply_text("⏳ Sveglia nel passato!"); return
 
-        # Carica/Salva allarmi per il PI associato
-        pi_alarms = load_alarms_for_pi(pi_id)
+        # Formato canonico (es. 7:05 → 07:05): è anche la chiave dell'allarme in /alarms/{pi_id}
+        date_str, time_str = alarm_dt_naive.strftime("%Y-%m-%d"), alarm_dt_naive.strftime("%H:%M")
         new_alarm = {"date": date_str, "time": time_str}
 
-        if new_alarm in pi_alarms:
+        # I duplicati si riconoscono dallo store in memoria, senza leggere Firebase
+        new_pi_ids = [p for p in target_pi_ids if not alarm_store.contains(p, date_str, time_str)]
+        if not new_pi_ids:
              await update.message.reply_text("⚠️ Sveglia già impostata per questo dispositivo!"); return
+        if not device_quota.allow_all(new_pi_ids):
+             await update.message.reply_text("⏳ Troppe modifiche per questi dispositivi, riprova tra qualche minuto."); return
 
-        pi_alarms.append(new_alarm)
-        save_alarms_for_pi(pi_id, pi_alarms)
-        await update.message.reply_text(f"✅ Sveglia per `{pi_id}`: {date_str} {time_str}", parse_mode='Markdown')
+        # Un'unica scrittura multi-path per tutti i Pi selezionati, senza rileggere le loro liste
+        if not add_alarm_for_pis(new_pi_ids, new_alarm):
+             await update.message.reply_text("❌ Errore durante il salvataggio."); return
+        for pi_id in new_pi_ids:
+            alarm_store.add(pi_id, date_str, time_str)
+        await update.message.reply_text(f"✅ Sveglia per {', '.join(f'`{p}`' for p in new_pi_ids)}: {date_str} {time_str}", parse_mode='Markdown')
 
     except ValueError:
         await update.message.reply_text("❌ Formato data/ora non valido (YYYY-MM-DD HH:MM)")
     except Exception as e:
-         logger.error(f"Errore in add_alarm per {pi_id}: {e}", exc_info=True)
+         logger.error(f"Errore in add_alarm per {target_pi_ids}: {e}", exc_info=True)
          await update.message.reply_text("❌ Errore interno.")
 
 
 @require_pairing # Applica il controllo
 async def list_alarms(update: Update, context: CallbackContext):
-    pi_id = context.user_data.get('pi_id')
-    pi_alarms = load_alarms_for_pi(pi_id)
-
-    if not pi_alarms:
-        await update.message.reply_text(f"🔕 Nessuna sveglia impostata per `{pi_id}`.", parse_mode='Markdown')
+    user_id = str(update.effective_user.id)
+    pi_ids = context.user_data.get('pi_ids', [])
+    target = context.args[0] if context.args else None
+    target_pi_ids = resolve_target_pi_ids(user_id, pi_ids, target)
+    if not target_pi_ids:
+        await update.message.reply_text(f"❌ Dispositivo o gruppo {md_escape(target)} non trovato.", parse_mode='Markdown')
         return
 
-    message = f"⏰ Sveglie per `{pi_id}`:\n" # Mostra a quale Pi si riferiscono
-    try:
-        sorted_alarms = sorted(pi_alarms, key=lambda x: f"{x.get('date', '0000-00-00')} {x.get('time', '00:00')}")
-    except Exception as e:
-         logger.error(f"Errore struttura dati allarmi per {pi_id}: {pi_alarms} - {e}")
-         await update.message.reply_text("❌ Errore leggendo dati sveglie."); return
+    message = ""
+    for pi_id, pi_alarms in load_alarms_for_pis(target_pi_ids).items():
+        if not pi_alarms:
+            message += f"🔕 Nessuna sveglia impostata per `{pi_id}`.\n\n"
+            continue
 
-    for i, alarm in enumerate(sorted_alarms):
-        message += f"{i+1}. {alarm.get('date', 'N/D')} alle {alarm.get('time', 'N/D')}\n"
-    await update.message.reply_text(message)
+        message += f"⏰ Sveglie per `{pi_id}`:\n" # Mostra a quale Pi si riferiscono
+        try:
+            sorted_alarms = sort_alarms(pi_alarms)
+        except Exception as e:
+             logger.error(f"Errore struttura dati allarmi per {pi_id}: {pi_alarms} - {e}")
+             await update.message.reply_text("❌ Errore leggendo dati sveglie."); return
+
+        for i, alarm in enumerate(sorted_alarms):
+            message += f"{i+1}. {alarm.get('date', 'N/D')} alle {alarm.get('time', 'N/D')}\n"
+        message += "\n"
+    await update.message.reply_text(message.strip(), parse_mode='Markdown')
 
 
 @require_pairing # Applica il controllo
+@require_quota # Dopo il pairing: gli utenti non associati non consumano quota
 async def delete_alarm(update: Update, context: CallbackContext):
-    pi_id = context.user_data.get('pi_id')
+    user_id = str(update.effective_user.id)
+    pi_ids = context.user_data.get('pi_ids', [])
     if not context.args or not context.args[0].isdigit():
         await update.message.reply_text("❌ Specifica l'ID numerico da `/list`.")
         return
 
+    # Con più dispositivi associati serve indicare da quale eliminare la sveglia
+    target = context.args[1] if len(context.args) > 1 else None
+    target_pi_ids = resolve_target_pi_ids(user_id, pi_ids, target)
+    if len(target_pi_ids) != 1:
+        await update.message.reply_text("❌ Specifica il dispositivo: `/delete ID ID_PI`", parse_mode='Markdown')
+        return
+    pi_id = target_pi_ids[0]
+
     pi_alarms = load_alarms_for_pi(pi_id)
     if not pi_alarms:
         await update.message.reply_text(f"🔕 Nessuna sveglia da eliminare per `{pi_id}`.", parse_mode='Markdown')
@@ -244,21 +588,18 @@ async def delete_alarm(update: Update, context: CallbackContext):
 
     try:
         # Ordina come in /list per far corrispondere l'ID
-        sorted_alarms = sorted(pi_alarms, key=lambda x: f"{x.get('date', '0000-00-00')} {x.get('time', '00:00')}")
+        sorted_alarms = sort_alarms(pi_alarms)
         alarm_index_to_delete = int(context.args[0]) - 1
 
         if 0 <= alarm_index_to_delete < len(sorted_alarms):
+            if not device_quota.allow(pi_id):
+                await update.message.reply_text("⏳ Troppe modifiche per questo dispositivo, riprova tra qualche minuto."); return
             alarm_to_remove = sorted_alarms[alarm_index_to_delete]
-            try:
-                # Rimuovi dalla lista originale
-                pi_alarms.remove(alarm_to_remove)
-                save_alarms_for_pi(pi_id, pi_alarms)
+            if delete_alarms({pi_id: [alarm_to_remove]}):
+                alarm_store.remove(pi_id, alarm_to_remove.get('date'), alarm_to_remove.get('time'))
                 await update.message.reply_text(f"🗑️ Sveglia {alarm_to_remove.get('date')} {alarm_to_remove.get('time')} eliminata per `{pi_id}`.", parse_mode='Markdown')
-            except ValueError:
-                 await update.message.reply_text("❌ Errore: Sveglia non trovata (bug?).")
-            except Exception as e_save:
-                 logger.error(f"Errore salvataggio dopo delete per {pi_id}: {e_save}")
-                 await update.message.reply_text("❌ Errore durante il salvataggio.")
+            else:
+                await update.message.reply_text("❌ Errore durante il salvataggio.")
         else:
             await update.message.reply_text("❌ ID non valido.")
     except Exception as e:
@@ -272,7 +613,12 @@ def check_and_trigger_alarms_runner():
     """Loop principale del thread che controlla gli allarmi per tutti i Pi."""
     global keep_running
     logger.info("Thread check_and_trigger_alarms: Avviato.")
-   
+    # Pulizia subito all'avvio: eventuali trigger booleani True rimasti non scadono da soli
+    sweep_expired_trigger_leases()
+    last_sweep_time = time.monotonic()
+    last_metrics_export_time = time.monotonic()
+    last_resync_time = time.monotonic()
+    written_leases = {} # {pi_id: expires_at} dei lease scritti da questo processo e non ancora rimossi
 
     while keep_running:
         now_aware = datetime.now(tz_info)
@@ -284,57 +630,47 @@ def check_and_trigger_alarms_runner():
 
         try:
             logger.debug(f"Controllo allarmi per {current_date_str} {current_time_str}")
-            all_pi_alarms = load_all_pi_alarms() # Carica {"pi_id": [alarms...]}
-
-            if not isinstance(all_pi_alarms, dict):
-                 logger.warning("load_all_pi_alarms non ha restituito un dizionario.")
-                 all_pi_alarms = {}
-
-            # Scansiona allarmi per ogni Pi registrato
-            for pi_id, pi_alarms_list in all_pi_alarms.items():
-                if isinstance(pi_alarms_list, list):
-                    for alarm in pi_alarms_list:
-                        # Controlla corrispondenza
-                        if isinstance(alarm, dict) and alarm.get("date") == current_date_str and alarm.get("time") == current_time_str:
-                            logger.info(f"MATCH! Allarme per PI `{pi_id}` alle {current_date_str} {current_time_str}")
-                            triggered_pi_ids_this_minute.add(pi_id)
-                            alarms_to_delete_this_minute.append({"pi_id": pi_id, "alarm_data": alarm})
-                else:
-                     logger.warning(f"Struttura allarmi non valida per pi_id {pi_id}")
-
-
-            # --- Scrittura/Reset Triggers ---
-            # Per semplicità, vengono gestiti tutti i triggers uno per uno
-            active_triggers_ref = db.reference('/triggers')
-            try:
-                 # Leggi tutti i trigger attuali per sapere quali resettare
-                 current_triggers = active_triggers_ref.get()
-                 if not isinstance(current_triggers, dict): current_triggers = {}
-            except Exception as e_read_triggers:
-                 logger.error(f"Errore leggendo i triggers esistenti: {e_read_triggers}")
-                 current_triggers = {}
-
-
-            # Imposta i trigger per i Pi attivi questo minuto
-            for pi_id_to_trigger in triggered_pi_ids_this_minute:
+            # Estrae dallo store in memoria gli allarmi del minuto corrente (ricerca binaria, nessuna lettura di /alarms)
+            current_alarm = {"date": current_date_str, "time": current_time_str}
+            for pi_id in alarm_store.pop_due(to_epoch_minute(current_date_str, current_time_str)):
+                logger.info(f"MATCH! Allarme per PI `{pi_id}` alle {current_date_str} {current_time_str}")
+                triggered_pi_ids_this_minute.add(pi_id)
+                alarms_to_delete_this_minute.append({"pi_id": pi_id, "alarm_data": current_alarm})
+
+
+            # --- Scrittura Trigger come lease ---
+            # Un solo update multi-path per i Pi attivi questo minuto, che rimuove anche i lease
+            # scritti in precedenza e già scaduti (senza leggere /triggers).
+            # Nessun reset: il Pi spegne la sveglia da solo alla scadenza del lease.
+            leases = {pi_id: make_trigger_lease(now_aware) for pi_id in triggered_pi_ids_this_minute}
+            now_ts = now_aware.timestamp()
+            expired = {pi_id: None for pi_id, expires_at in written_leases.items() if expires_at <= now_ts and pi_id not in leases}
+            if leases or expired:
                 try:
-                    # Scrivi True solo se non è già True per evitare scritture inutili
-                    if current_triggers.get(pi_id_to_trigger) is not True:
-                         logger.info(f"Invio trigger=True a Firebase per PI `{pi_id_to_trigger}`")
-                         db.reference(f'/triggers/{pi_id_to_trigger}').set(True)
-                    else:
-                         logger.debug(f"Trigger per PI `{pi_id_to_trigger}` già True.")
+                    if leases:
+                        logger.info(f"Invio lease trigger a Firebase per {len(leases)} PI: {sorted(leases)}")
+                    db.reference('/triggers').update({**expired, **leases})
+                    for pi_id in expired:
+                        del written_leases[pi_id]
+                    written_leases.update({pi_id: lease["expires_at"] for pi_id, lease in leases.items()})
                 except Exception as e_set:
-                     logger.error(f"Errore impostando trigger per {pi_id_to_trigger}: {e_set}")
+                    logger.error(f"Errore scrivendo i lease dei trigger: {e_set}")
+
+            # Pulizia periodica dei lease rimasti (scritture fallite, riavvii del bot)
+            if time.monotonic() - last_sweep_time >= LEASE_SWEEP_INTERVAL:
+                sweep_expired_trigger_leases()
+                last_sweep_time = time.monotonic()
 
-            # Resetta i trigger per i Pi che erano attivi ma non lo sono questo minuto
-            for pi_id_was_active, trigger_value in current_triggers.items():
-                 if trigger_value is True and pi_id_was_active not in triggered_pi_ids_this_minute:
-                     try:
-                         logger.info(f"Reset trigger=False a Firebase per PI `{pi_id_was_active}`")
-                         db.reference(f'/triggers/{pi_id_was_active}').set(False)
-                     except Exception as e_reset:
-                          logger.error(f"Errore resettando trigger per {pi_id_was_active}: {e_reset}")
+            # Riallineamento periodico con /alarms: recupera modifiche fatte fuori da questo processo
+            # (console Firebase, altre istanze, cancellazioni fallite)
+            if time.monotonic() - last_resync_time >= ALARM_STORE_RESYNC_INTERVAL:
+                reload_alarm_store()
+                last_resync_time = time.monotonic()
+
+            # Esportazione periodica delle metriche di quota
+            if time.monotonic() - last_metrics_export_time >= METRICS_EXPORT_INTERVAL:
+                export_quota_metrics()
+                last_metrics_export_time = time.monotonic()
 
 
             # --- Cancellazione Allarmi Triggerati ---
@@ -349,24 +685,8 @@ def check_and_trigger_alarms_runner():
                         alarms_by_pi_to_delete[pid] = []
                     alarms_by_pi_to_delete[pid].append(adata)
 
-                # Processa ogni Pi che ha allarmi da cancellare
-                for del_pi_id, alarms_to_remove in alarms_by_pi_to_delete.items():
-                    try:
-                        current_pi_alarms = load_alarms_for_pi(del_pi_id) # Ricarica lista attuale
-                        if isinstance(current_pi_alarms, list):
-                            original_count = len(current_pi_alarms)
-                            updated_pi_alarms = [a for a in current_pi_alarms if a not in alarms_to_remove]
-                            removed_count = original_count - len(updated_pi_alarms)
-
-                            if removed_count > 0:
-                                logger.info(f"Rimossi {removed_count} allarmi per PI `{del_pi_id}`. Salvo lista aggiornata.")
-                                save_alarms_for_pi(del_pi_id, updated_pi_alarms)
-                            else:
-                                logger.warning(f"Nessun allarme trovato da rimuovere per PI `{del_pi_id}`.")
-                        else:
-                             logger.error(f"Impossibile cancellare, load_alarms_for_pi non ha restituito lista per `{del_pi_id}`")
-                    except Exception as e_del:
-                         logger.error(f"Errore durante la cancellazione allarmi per PI `{del_pi_id}`: {e_del}", exc_info=True)
+                # Un unico update multi-path rimuove gli allarmi per chiave, senza rileggere le liste
+                delete_alarms(alarms_by_pi_to_delete)
 
 
         except Exception as e:
@@ -400,6 +720,12 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
 
 
+    # Lettura completa di /alarms all'avvio; poi lo store è aggiornato da handler e checker
+    # e riallineato ogni ALARM_STORE_RESYNC_INTERVAL secondi
+    while keep_running and not reload_alarm_store():
+        logger.warning(f"Nuovo tentativo di caricamento allarmi tra {ALARM_LOAD_RETRY_INTERVAL} secondi...")
+        time.sleep(ALARM_LOAD_RETRY_INTERVAL)
+
     alarm_checker_thread = threading.Thread(target=check_and_trigger_alarms_runner, name="AlarmChecker", daemon=True)
     alarm_checker_thread.start()
     logger.info("Thread controllo allarmi avviato.")
@@ -410,6 +736,8 @@ def main():
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("pair", pair_command))
     application.add_handler(CommandHandler("unpair", unpair_command))
+    application.add_handler(CommandHandler("group", group_command))
+    application.add_handler(CommandHandler("ungroup", ungroup_command))
     application.add_handler(CommandHandler("add", add_alarm))
     application.add_handler(CommandHandler("list", list_alarms))
     application.add_handler(CommandHandler("delete", delete_alarm))